@@ -19,14 +19,41 @@ A + L = 0 + 11 = 11 -> L (L is the 11th letter in the alphabet, using -0- based
 """
 
 import json
-from operator import le
-from string import ascii_uppercase
+from collections.abc import Iterator
 
 import click
+import numpy as np
+import orjson
 from icecream import ic
+from numba import njit, prange
 
 VERSION = "2.0"
 
+# Texts are ciphered and written to disk this many characters at a time.
+CHUNK_SIZE = 1 << 20
+
+# Chunks with at least this many characters are ciphered using the multi-threaded kernel.
+PARALLEL_THRESHOLD = 1 << 20
+
+# Number of unicode code points (U+0000 to U+10FFFF); all code point arithmetic is done modulo this value.
+UNICODE_SIZE = np.uint32(0x110000)
+
+# ascii_cipher() is only used when every key position covers at least this many characters of the text. With shorter
+# strided slices, the Python overhead of one translate() call per key character costs more than the code point kernel.
+MIN_TRANSLATE_SLICE = 1024
+
+# Chunks that are not ASCII as a whole are retried with ascii_cipher() in blocks of this many characters (or more, for long
+# keys), so that a stray non-ASCII character only sends its own block through the code point kernel.
+ASCII_BLOCK_SIZE = 1 << 16
+# After this many consecutive non-ASCII blocks, the rest of the chunk goes straight to the kernel.
+MAX_FAILED_BLOCKS = 2
+
+# bytes.translate() tables for ASCII text and key, indexed by the code point of the key character.
+# Encryption: ASCII + ASCII is always < 256. Non-ASCII bytes never occur in the text, so their entries are unused.
+ENCRYPT_TABLES: tuple[bytes, ...] = tuple(bytes(range(shift, shift + 128)) + bytes(128) for shift in range(128))
+# Decryption: bytes that would not decrypt to ASCII map to 0xFF so that the caller can detect them with isascii().
+DECRYPT_TABLES: tuple[bytes, ...] = tuple(b'\xff' * shift + bytes(range(128)) + b'\xff' * (128 - shift) for shift in range(128))
+
 
 @click.command(help="Encrypt/decrypt plaintext using Vigenere cipher.", epilog="To encrypt, provide quote-delimited [PLAINTEXT] and [KEY] on the command line. [PLAINTEXT] can include any unicode characters. Encrypted text is saved in \"encrypted.json\". To decrypt, run this program with no arguments. The decrypted text is saved in \"decrypted.json\".")
 @click.argument("plaintext", required=False, type=str)
@@ -44,75 +71,254 @@ def cli(plaintext: str, key: str) -> None:
         exit()
 
     if plaintext:
-        # The key is not only expanded, but modified to preserve case of the text when decrypted.
-        cipher_key: list[str] = generate_key(plaintext, key)
-        cipher(plaintext, cipher_key, key)
+        cipher(plaintext, key)
     else:
         decipher()
 
 
-def generate_key(plaintext: str, key: str) -> list[str]:
+@njit(inline='always')
+def shift_code_point(text_point: np.uint32, key_point: np.uint32, encrypt: bool) -> np.uint32:
+    """
+    Shift one code point of the text by one code point of the key.
+
+    CODENOTE:
+        -- Decryption adds the complement (0x110000 - key) rather than subtracting so that unsigned arithmetic never wraps below zero.
+        -- Everything stays uint32 so that LLVM vectorizes the calling loop with 32-bit lanes (8 code points per AVX2 instruction).
+    """
+    shift = key_point if encrypt else UNICODE_SIZE - key_point
+    total = np.uint32(text_point + shift)
+    # total is always < 2 * 0x110000, so one branchless conditional subtract replaces the modulo (a division).
+    return total - UNICODE_SIZE * np.uint32(total >= UNICODE_SIZE)
+
+
+@njit(cache=True, boundscheck=False)
+def vigenere_kernel(text_arr: np.ndarray, key_arr: np.ndarray, out: np.ndarray, encrypt: bool) -> None:
     """
-    Create a vigenere key that is the same length as the length of the plain text.
+    Shift each code point in text_arr by the corresponding code point in key_arr, writing the result to out.
 
     Parameters
     ----------
-    plaintext : str -- the text that will be encrypted/decrypted
-    key : str -- the original vigenere key, as a string
+    text_arr : np.ndarray -- uint32 code points of the plain text or the encrypted text
+    key_arr : np.ndarray -- uint32 code points of the expanded key; same length as text_arr
+    out : np.ndarray -- preallocated uint32 array, same length as text_arr
+    encrypt : bool -- True to encrypt; False to decrypt
+
+    CODENOTE:
+        -- Compiled lazily, on first use, rather than at import. Command line input never gets near PARALLEL_THRESHOLD, so eager compilation made every run load the parallel kernel for nothing.
+        -- All arrays passed in are C-contiguous, so the compiled loop still uses packed vector loads and stores.
+    """
+    for i in range(text_arr.size):
+        out[i] = shift_code_point(text_arr[i], key_arr[i], encrypt)
+
+
+@njit(cache=True, boundscheck=False, parallel=True)
+def vigenere_kernel_parallel(text_arr: np.ndarray, key_arr: np.ndarray, out: np.ndarray, encrypt: bool) -> None:
+    """
+    Multi-threaded version of vigenere_kernel(); the parameters are the same.
+
+    CODENOTE:
+        -- This must stay a separate Python function. Numba's cache is keyed on the function and signature, not on parallel=True, so compiling vigenere_kernel() a second time with parallel=True would load the serial code from the cache.
+    """
+    for i in prange(text_arr.size):
+        out[i] = shift_code_point(text_arr[i], key_arr[i], encrypt)
+
+
+def ascii_cipher(text: str, key: str, encrypt: bool) -> str | None:
+    """
+    Encrypt or decrypt text with one bytes.translate() call per character of the original key.
+
+    Every key-length-th character of the text (text[ndx::len(key)]) is shifted by the same key character, so each of those strided slices is translated with a single 256-entry table.
+
+    Parameters
+    ----------
+    text : str -- either the plain text or the encrypted text
+    key : str -- the original key
+    encrypt : bool -- True to encrypt; False to decrypt
 
     Returns
     -------
-    list[str] -- the vigenere key
-            -- The original key is expanded so that there is one letter for each letter in the plain text
-            -- The expanded key also contains capitalization that matches that of the plaintext for correct decryption.
+    str | None -- the encrypted/decrypted text
+               -- None if the text or key falls outside ASCII (or, for decryption, if the result does), or if the key is too long for the text to make the strided slices worthwhile. cipher() then uses the code point kernel instead.
+    """
+    if not key.isascii() or len(text) < len(key) * MIN_TRANSLATE_SLICE:
+        return None
+
+    if encrypt:
+        # str.isascii() is O(1): CPython records whether a string is pure ASCII when the string is created.
+        if not text.isascii():
+            return None
+        text_bytes: bytes = text.encode('ascii')
+    else:
+        # Encrypted ASCII is at most 254, so anything outside latin-1 cannot decrypt to ASCII.
+        try:
+            text_bytes = text.encode('latin-1')
+        except UnicodeEncodeError:
+            return None
+
+    step: int = len(key)
+    c: bytearray = bytearray(len(text_bytes))
+    tables: tuple[bytes, ...] = ENCRYPT_TABLES if encrypt else DECRYPT_TABLES
+    for ndx, k in enumerate(key):
+        c[ndx::step] = text_bytes[ndx::step].translate(tables[ord(k)])
 
+    if not encrypt and not c.isascii():
+        return None
+
+    return c.decode('latin-1')
+
+
+def kernel_cipher(text: str, key_arr: np.ndarray, c: np.ndarray, encrypt: bool) -> str:
+    """
+    Encrypt or decrypt text with the code point kernel.
+
+    Parameters
+    ----------
+    text : str -- either the plain text or the encrypted text; at most CHUNK_SIZE characters
+    key_arr : np.ndarray -- uint32 code points of the key, already rotated to line up with the start of text; at least as long as text
+    c : np.ndarray -- reusable uint32 output buffer, at least as long as text
+    encrypt : bool -- True to encrypt; False to decrypt
+
+    Returns
+    -------
+    str -- the encrypted/decrypted text
     """
-    cipher_key: list[str] = []
-    for i in range(len(plaintext)):
-        e = i % len(key)
-        cipher_key.append(key[e])
+    # Work on code points as uint32 arrays. "surrogatepass" lets lone surrogates (which the cipher can produce) round-trip.
+    text_arr: np.ndarray = np.frombuffer(text.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+    n: int = text_arr.size
+
+    if n >= PARALLEL_THRESHOLD:
+        vigenere_kernel_parallel(text_arr, key_arr[:n], c[:n], encrypt)
+    else:
+        vigenere_kernel(text_arr, key_arr[:n], c[:n], encrypt)
 
-    return cipher_key
+    # Decode straight from the output array's buffer; c.tobytes() would make another full-length copy first.
+    return str(c[:n].data, 'utf-32-le', 'surrogatepass')
 
 
-def cipher(text: str, cipher_key: list[str], key: str, encrypt=True) -> None:
+def cipher_chunks(text: str, key: str, encrypt: bool) -> Iterator[str]:
     """
-    Encrypt (if "encrypt" is True) or decrypt (if "encrypt" is False) the passed in text.
+    Encrypt or decrypt the text CHUNK_SIZE characters at a time.
 
     Parameters
     ----------
     text : str -- either the plain text or the encrypted text
-    cipher_key : list[str] -- the expanded key
     key : str -- the original key
-    encrypt : bool, optional -- True to encrypt; False to decrypt, by default True
+    encrypt : bool -- True to encrypt; False to decrypt
+
+    CODENOTE:
+        -- The key is never expanded to the length of the whole text. The kernel's key and output arrays are allocated once, at most one chunk long, and reused by every chunk.
+        -- A chunk that cannot take the ASCII path as a whole is split into ASCII_BLOCK_SIZE blocks. Blocks that are ASCII still go through translate(); each run of the other blocks goes through the kernel in one call. A few non-ASCII characters in a mostly ASCII text therefore only cost the blocks they are in. Once MAX_FAILED_BLOCKS blocks in a row fail, the chunk is treated as Unicode text and the rest of it goes through the kernel.
+
+    Yields
+    ------
+    str -- the next piece of encrypted/decrypted text
+    """
+    # A key made only of U+0000 characters shifts nothing, and neither does an empty key, so the text is passed through.
+    if not key.strip('\x00'):
+        for start in range(0, len(text), CHUNK_SIZE):
+            yield text[start:start + CHUNK_SIZE]
+        return
+
+    # Allocated the first time a chunk needs the kernel, since pure ASCII texts never do.
+    key_arr: np.ndarray | None = None
+    c: np.ndarray | None = None
+
+    # Blocks must be long enough for ascii_cipher() to accept them with this key.
+    block_size: int = max(ASCII_BLOCK_SIZE, len(key) * MIN_TRANSLATE_SLICE)
+
+    for start in range(0, len(text), CHUNK_SIZE):
+        chunk: str = text[start:start + CHUNK_SIZE]
+
+        # Rotate the original key so that its first character lines up with the start of the chunk.
+        offset: int = start % len(key)
+
+        # ASCII text and key are shifted with bytes.translate(); anything else goes through the code point kernel.
+        encrypted_chunk: str | None = ascii_cipher(chunk, key[offset:] + key[:offset], encrypt)
+        if encrypted_chunk is not None:
+            yield encrypted_chunk
+            continue
+
+        if key_arr is None or c is None:
+            chunk_size: int = min(len(text), CHUNK_SIZE)
+            key_points: np.ndarray = np.frombuffer(key.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+            # np.tile() repeats the key with a single copy loop. np.resize() would concatenate a tuple holding one entry per repetition.
+            # The extra len(key) code points let any rotation of the key be taken as a slice: key_arr[offset:].
+            key_arr = np.tile(key_points, -(-(chunk_size + len(key)) // len(key)))
+            c = np.empty(chunk_size, dtype=np.uint32)
+
+        # Start of the text that has not been ciphered yet, i.e. of the current run of non-ASCII blocks.
+        run_start: int = 0
+
+        if key.isascii() and len(chunk) > block_size:
+            failed_blocks: int = 0
+            for block_start in range(0, len(chunk), block_size):
+                block_offset: int = (start + block_start) % len(key)
+                encrypted_block: str | None = ascii_cipher(chunk[block_start:block_start + block_size], key[block_offset:] + key[:block_offset], encrypt)
+                if encrypted_block is None:
+                    # Two non-ASCII blocks in a row: this is not a mostly ASCII chunk, so stop slicing it up and let the kernel take the rest.
+                    failed_blocks += 1
+                    if failed_blocks == MAX_FAILED_BLOCKS:
+                        break
+                    continue
+
+                failed_blocks = 0
+
+                if run_start < block_start:
+                    yield kernel_cipher(chunk[run_start:block_start], key_arr[(start + run_start) % len(key):], c, encrypt)
+                yield encrypted_block
+                run_start = block_start + block_size
+
+        if run_start < len(chunk):
+            yield kernel_cipher(chunk[run_start:], key_arr[(start + run_start) % len(key):], c, encrypt)
+
+
+def json_chunk(chunk: str) -> bytes:
     """
+    JSON-encode a chunk of text as UTF-8, without the quotes that surround a JSON string.
 
-    c: list[str] = []
+    Parameters
+    ----------
+    chunk : str -- a chunk of encrypted/decrypted text, or the key
 
-    text_ord: list[int] = [ord(i) for i in text]
-    cipher_key_ord: list[int] = [ord(i) for i in cipher_key]
-    z = zip(text_ord, cipher_key_ord)
+    Returns
+    -------
+    bytes -- the escaped text, ready to be written between the quotes of a JSON string
+    """
+    try:
+        return orjson.dumps(chunk)[1:-1]
+    except orjson.JSONEncodeError:
+        # orjson rejects lone surrogates, which the cipher can produce; json escapes them as \udXXX instead.
+        return json.dumps(chunk)[1:-1].encode('utf-8')
 
-    if encrypt:
-        for x,y in z:
-            diff: int =  (x + y) % 0x110000
-            c.append(chr(diff))
-    else:
-        for x,y in z:
-            diff: int = (x - y) % 0x110000
-            c.append(chr(diff))
 
-    encrypted_text: str = "".join(c)
-    # print(f'Encrypted text:\n{encrypted_text}', sep="")
+def cipher(text: str, key: str, encrypt: bool = True) -> None:
+    """
+    Encrypt (if "encrypt" is True) or decrypt (if "encrypt" is False) the passed in text.
 
-    encrypted_dict: dict[str, str] = {'encrypted_text': encrypted_text, 'cipher_key': key}
+    Parameters
+    ----------
+    text : str -- either the plain text or the encrypted text
+    key : str -- the original key
+    encrypt : bool, optional -- True to encrypt; False to decrypt, by default True
+
+    CODENOTE:
+        -- The JSON is written one chunk at a time so that the whole encrypted text is never held in memory, either as a string or as its JSON encoding. Each chunk is written without its quotes, so the chunks join into one continuous JSON string.
+    """
 
     if encrypt:
-        with open('encrypted.json', 'w', encoding="utf-8") as f:
-            json.dump(encrypted_dict, f)
+        # Encoded before the file is opened, so that an encoding error cannot leave a half-written file behind.
+        json_key: bytes = json_chunk(key)
+        with open('encrypted.json', 'wb') as f:
+            f.write(b'{"encrypted_text":"')
+            for chunk in cipher_chunks(text, key, encrypt):
+                f.write(json_chunk(chunk))
+            f.write(b'","cipher_key":"' + json_key + b'"}')
     else:
-        with open('decrypted.json', 'w', encoding="utf-8") as f:
-            json.dump(encrypted_text, f, ensure_ascii=False)
+        with open('decrypted.json', 'wb') as f:
+            f.write(b'"')
+            for chunk in cipher_chunks(text, key, encrypt):
+                f.write(json_chunk(chunk))
+            f.write(b'"')
 
 
 def decipher() -> None:
@@ -120,17 +326,16 @@ def decipher() -> None:
     Given an encrypted text, generate the decrypted text using the encryption key.
 
     CODENOTE:
-        -- The encrypted text is sent to the same function as the plain text. The fourth argument tells cipher() to decrypt rather than encrypt.
+        -- The encrypted text is sent to the same function as the plain text. The third argument tells cipher() to decrypt rather than encrypt.
     """
 
     with open("encrypted.json", 'r', encoding='utf-8') as f:
-        encrypted_dict = json.load(f)
+        encrypted_dict: dict[str, str] = json.load(f)
 
     ciphertext: str = encrypted_dict['encrypted_text']
     key: str = encrypted_dict['cipher_key']
-    cipher_key: list[str] = generate_key(ciphertext, key)
 
-    cipher(ciphertext, cipher_key, key, False)
+    cipher(ciphertext, key, False)
 
 
 if __name__ == '__main__':